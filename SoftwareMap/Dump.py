@@ -0,0 +1,206 @@
+import bz2
+import gzip
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Iterator, List, Set, TextIO, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+SOFTWARE_QID = "Q7397"
+
+_ENTITY = "<" + ENTITY_PREFIX
+_INSTANCE_OF = "<http://www.wikidata.org/prop/direct/P31>"
+_SUBCLASS_OF = "<http://www.wikidata.org/prop/direct/P279>"
+_LABEL = "<http://www.w3.org/2000/01/rdf-schema#label>"
+
+
+class WikidataDump:
+    """
+    Read the software class hierarchy and its instances from a local copy of the WikiData truthy N-Triples dump
+    (https://dumps.wikimedia.org/wikidatawiki/entities/latest-truthy.nt.bz2) instead of the SPARQL endpoint. The dump
+    is streamed line by line, twice, yielding the same dictionaries as Tasks._get_software_classes and
+    Tasks._get_software_instances.
+    """
+
+    def __init__(self, path: str, language: str = "en"):
+        """
+        :param path: Path of the dump, optionally compressed with bz2 (.bz2) or gzip (.gz)
+        :param language: Language of the labels to read
+        """
+        self.path = path
+        self.language = language
+        self._parents_of = None
+        self._class_labels = None
+        self._instances = None
+        self._instance_labels = None
+        self._load_lock = threading.Lock()
+
+    def software_classes(self) -> Iterator[Dict[str, str]]:
+        """
+        Yield every subclass relation between two classes below software
+        :return: A generator of dictionaries {"child_uri": <child_uri>, "child_label": <child_label>, ... }
+        """
+        self._load()
+        for child, parents in self._parents_of.items():
+            for parent in parents:
+                yield {
+                    "child_uri": ENTITY_PREFIX + child,
+                    "child_label": self._class_labels.get(child, child),
+                    "parent_uri": ENTITY_PREFIX + parent,
+                    "parent_label": self._class_labels.get(parent, parent),
+                }
+
+    def software_instances(self) -> Iterator[Dict[str, str]]:
+        """
+        Yield every instance of a class below software
+        :return: A generator of dictionaries {"child_uri": <child_uri>, "child_label": <child_label>, ... }
+        """
+        self._load()
+        for item, class_ in self._instances:
+            yield {
+                "child_uri": ENTITY_PREFIX + item,
+                "child_label": self._instance_labels.get(item, item),
+                "parent_uri": ENTITY_PREFIX + class_,
+                "parent_label": self._class_labels.get(class_, class_),
+            }
+
+    def _load(self):
+        """
+        Build the software class hierarchy from the subclass triples, then collect the instance triples and the labels
+        in a second pass. Both passes are only run once per object, even when both generators start at once
+        """
+        with self._load_lock:
+            if self._parents_of is None:
+                self._read_hierarchy()
+
+    def _read_hierarchy(self):
+        """
+        Run the two passes of _load
+        """
+        logger.info("Reading subclass relations from dump . . .")
+        children_of = defaultdict(list)
+        for subject, predicate, object_ in self._triples():
+            if predicate == _SUBCLASS_OF:
+                qid = _qid(object_)
+                if qid is not None:
+                    children_of[qid].append(_qid(subject))
+        classes = _descendants(children_of, SOFTWARE_QID)
+        logger.info(f"Complete. Found {len(classes)} software classes")
+
+        # Only keep relations between two software classes, as the SPARQL class query does
+        parents_of = defaultdict(list)
+        for parent in classes:
+            for child in children_of.get(parent, []):
+                if child in classes:
+                    parents_of[child].append(parent)
+        del children_of
+
+        # Which classes are software is only known once every subclass triple has been read, so instances need a second
+        # pass. The dump is written entity by entity, all triples of a subject are adjacent: its label is kept until the
+        # subject changes, so instance and class labels are read in this same pass
+        logger.info("Reading software instances and labels from dump . . .")
+        self._instances = []
+        self._instance_labels = {}
+        self._class_labels = {}
+        subject = None
+        label = None
+        subject_classes = []
+        for triple_subject, predicate, object_ in self._triples():
+            if triple_subject != subject:
+                self._add_subject(subject, label, subject_classes, classes)
+                subject, label, subject_classes = triple_subject, None, []
+            if predicate == _INSTANCE_OF:
+                class_ = _qid(object_)
+                if class_ in classes:
+                    subject_classes.append(class_)
+            elif predicate == _LABEL and label is None:
+                label = self._label(object_)
+        self._add_subject(subject, label, subject_classes, classes)
+        logger.info(f"Complete. Found {len(self._instances)} software instance relations")
+        # Set last, it marks the hierarchy as loaded
+        self._parents_of = parents_of
+
+    def _add_subject(self, subject: str, label: str, subject_classes: List[str], classes: Set[str]):
+        """
+        Record the software instance relations and the label of one subject of the second pass
+        :param subject: The subject term, None before the first triple
+        :param label: The subject's label, None if it has none in the configured language
+        :param subject_classes: The software classes the subject is an instance of
+        :param classes: All software classes
+        """
+        if subject is None:
+            return
+        qid = _qid(subject)
+        for class_ in subject_classes:
+            self._instances.append((qid, class_))
+        if label is not None:
+            if subject_classes:
+                self._instance_labels[qid] = label
+            if qid in classes:
+                self._class_labels[qid] = label
+
+    def _label(self, literal: str) -> str:
+        """
+        Return the text of an N-Triples language-tagged literal if it is in the configured language
+        :param literal: The literal, e.g. "Linux"@en
+        """
+        text, _, language = literal.rpartition("@")
+        if language != self.language:
+            return None
+        try:
+            # N-Triples string escapes are a subset of JSON's
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            return text.strip('"')
+
+    def _triples(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Yield (subject, predicate, object) for every line of the dump, with the trailing " ." removed from the object
+        """
+        with _open(self.path) as dump:
+            for line in dump:
+                parts = line.rstrip().split(" ", 2)
+                if len(parts) == 3:
+                    yield parts[0], parts[1], parts[2][:-2]
+
+
+def _open(path: str) -> TextIO:
+    """
+    Open a dump file for reading as text, decompressing it according to its extension
+    :param path: Path of the dump
+    """
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def _qid(term: str) -> str:
+    """
+    Return the entity id of an N-Triples WikiData entity term, or None for any other term
+    :param term: The term, e.g. <http://www.wikidata.org/entity/Q7397>
+    """
+    if term.startswith(_ENTITY):
+        return term[len(_ENTITY):-1]
+    return None
+
+
+def _descendants(children_of: Dict[str, List[str]], root: str) -> Set[str]:
+    """
+    Return root and all of its descendants, walking the hierarchy breadth first
+    :param children_of: Child entity ids keyed by parent entity id
+    :param root: The entity id to start from
+    """
+    visited = {root}
+    queue = deque([root])
+    while queue:
+        for child in children_of.get(queue.popleft(), []):
+            if child not in visited:
+                visited.add(child)
+                queue.append(child)
+    return visited
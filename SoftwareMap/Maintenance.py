@@ -1,268 +1,673 @@
+import gzip
+import hashlib
 import math
-import json
 import logging
-from random import shuffle
-from datetime import datetime
-from typing import Dict, List, Tuple
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION, ThreadPoolExecutor, as_completed, wait
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from itertools import islice
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+import ijson
+import requests
 from neo4j import GraphDatabase
-from SPARQLWrapper import SPARQLWrapper, JSON
+from requests.adapters import HTTPAdapter
+
+from SoftwareMap.Dump import WikidataDump
 
 logger = logging.getLogger(__name__)
 
+URI_LABELS = ("Class", "Software", "Genre")
+
+WIKIDATA_SPARQL_URL = "https://query.wikidata.org/sparql"
+WIKIDATA_USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) "
+                       "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36")
+
+# One session for all WikiData queries, so concurrent batch queries reuse kept-alive TLS connections
+_wikidata_session = requests.Session()
+_wikidata_session.headers.update({"User-Agent": WIKIDATA_USER_AGENT, "Accept": "application/sparql-results+json"})
+_wikidata_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+# WikiData allows 5 concurrent queries per client. The class and instance pipelines query at the same time, so every
+# query takes a slot rather than relying on the worker count of a single pool
+WIKIDATA_MAX_CONCURRENT_QUERIES = 4
+_wikidata_slots = threading.BoundedSemaphore(WIKIDATA_MAX_CONCURRENT_QUERIES)
+# (connect, read) seconds. WikiData stops queries after 60 seconds, a read stalled for longer is a dead connection
+WIKIDATA_TIMEOUT = (10, 90)
+# Number of times a rate limited (HTTP 429) query is sent again after waiting for Retry-After
+WIKIDATA_RATE_LIMIT_RETRIES = 5
+
+# Merge query of Tasks._merge_data for each (child label, relationship) pair. The text is built once at import, so
+# every batch of every run sends identical query text and reuses the server's cached plan
+MERGE_QUERIES = {
+    (db_label, relationship): f"""UNWIND $batch AS data
+                    OPTIONAL MATCH (existing: {db_label} {{uri: data.child_uri}})
+                    WITH data, existing WHERE existing IS NULL OR existing.created = $created
+                    MERGE(child: {db_label} {{uri: data.child_uri}})
+                        ON CREATE SET child.label = data.child_label, child.created = $created
+                    MERGE(parent: Class {{uri: data.parent_uri}})
+                        ON CREATE SET parent.label = data.parent_label, parent.created = $created
+                    MERGE(child)-[relation: {relationship}] -> (parent)
+                        ON CREATE SET relation.created = $created
+                """
+    for db_label, relationship in (("Class", "SUBCLASS"), ("Software", "INSTANCE"))
+}
+
+# URIs of a batch which have no node of the label yet, or whose node was created by the current run. These are the rows
+# the merge query does not skip
+NEW_URIS_QUERY = """UNWIND $uris AS uri
+                    OPTIONAL MATCH (existing: {db_label} {{uri: uri}})
+                    WITH uri, existing WHERE existing IS NULL OR existing.created = $created
+                    RETURN uri
+                 """
+
+SPARQL_CACHE_DIR = Path("~/.cache/softwaremap").expanduser()
+SPARQL_CACHE_TTL = 24 * 60 * 60  # seconds
+# Set once expired cache entries have been deleted by this process
+_sparql_cache_pruned = threading.Event()
+
 
 class Tasks:
-    def __init__(self, server: str, auth: Tuple[str, str]):
+    def __init__(self, server: str, auth: Tuple[str, str], max_connection_pool_size: int = 64,
+                 connection_acquisition_timeout: float = 120, connection_timeout: float = 30,
+                 max_retry_time: float = 30):
+        """
+        Connect to the database and ensure the uniqueness constraints exist. The driver (and its connection pool) is
+        kept for the lifetime of the object, so reuse one Tasks instance across operations and close it when done.
+        :param server: Bolt URI of the database
+        :param auth: (user, password) tuple
+        :param max_connection_pool_size: Maximum number of connections the driver keeps open to the server
+        :param connection_acquisition_timeout: Seconds to wait for a free connection from the pool
+        :param connection_timeout: Seconds to wait for a new connection to be established
+        :param max_retry_time: Seconds a managed transaction is retried for on transient errors
+        """
         logger.info("Connecting to database . . .")
-        self.driver = GraphDatabase.driver(server, auth=auth)
+        self.driver = GraphDatabase.driver(server, auth=auth,
+                                           max_connection_pool_size=max_connection_pool_size,
+                                           connection_acquisition_timeout=connection_acquisition_timeout,
+                                           connection_timeout=connection_timeout,
+                                           keep_alive=True,
+                                           max_retry_time=max_retry_time)
         logger.info("Connection complete")
         logger.info("Apply uniqueness constraints to database . . .")
+        # The constraints are backed by an index on uri, which keeps every MERGE/MATCH on uri an index lookup instead
+        # of a label scan. Creating an existing constraint is a no-op
         with self.driver.session() as session:
-            session.run("CREATE CONSTRAINT ON (node:Class) ASSERT (node.uri) IS UNIQUE")
-            session.run("CREATE CONSTRAINT ON (node:Software) ASSERT (node.uri) IS UNIQUE")
-            session.run("CREATE CONSTRAINT ON (node:Genre) ASSERT (node.uri) IS UNIQUE")
+            for db_label in URI_LABELS:
+                session.run(f"CREATE CONSTRAINT ON (node:{db_label}) ASSERT (node.uri) IS UNIQUE").consume()
         logger.info("Complete")
 
-    def add_genre_to_videogames(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Close the driver and all pooled connections
+        """
+        self.driver.close()
+
+    def add_genre_to_videogames(self, batch_size: int = 500, batches_per_transaction: int = 4):
+        """
+        Add genre nodes and relationships to video games which exist in the database
+        :param batch_size: Number of games per statement
+        :param batches_per_transaction: Number of statements committed together in one transaction
+        """
         logger.info('Fetching current instances of "video game" with genre . . .')
-        wikidata_query = _sparql_results("""
-            SELECT DISTINCT ?item ?genre ?genreLabel WHERE {
+        wikidata_query = [(game["item"]["value"], game["genre"]["value"]) for game in _sparql_results("""
+            SELECT DISTINCT ?item ?genre WHERE {
                 ?item wdt:P31/wdt:P279* wd:Q7889;
                     wdt:P136 ?genre
-                SERVICE wikibase:label { bd:serviceParam wikibase:language "en". }
             }
-        """)
-        wikidata_games = [{
-            "game_uri": game["item"]["value"],
-            "genre_uri": game["genre"]["value"],
-            "genre_label": game["genreLabel"]["value"]
-        } for game in wikidata_query["results"]["bindings"]]
+        """)]
+        genre_labels = _get_labels(genre_uri for _, genre_uri in wikidata_query)
+        # Row dicts are only built one batch at a time, as they are sent
+        wikidata_games = ({
+            "game_uri": game_uri,
+            "genre_uri": genre_uri,
+            "genre_label": genre_labels[genre_uri]
+        } for game_uri, genre_uri in wikidata_query)
         logger.info("Complete")
 
-        logger.info(f'Adding {len(wikidata_games)} genre labels to existing games . . .')
+        logger.info(f'Adding {len(wikidata_query)} genre labels to existing games . . .')
+        created = datetime.now(timezone.utc)
+        nodes_created = 0
+        relationships_created = 0
         with self.driver.session() as session:
-            query = session.run("""
-                UNWIND $games as game
-                    MATCH (v:Software {uri: game.game_uri})
-                    MERGE (g:Genre {uri: game.genre_uri})
-                        ON CREATE SET g.label = game.genre_label, g.created = datetime()
-                    MERGE (v)-[m:MEMBER]->(g)
-                        ON CREATE SET m.created = datetime()
-            """, games=wikidata_games)
-            result = query.consume()
-            nodes_created = result.counters.nodes_created
-            relationships_created = result.counters.relationships_created
-            logger.info(f"Complete. Created {nodes_created} nodes, {relationships_created} relationships")
-
-    def add_date_of_release(self):
+            for batches in _generate_batches(_generate_batches(wikidata_games, batch_size), batches_per_transaction):
+                summaries = session.write_transaction(_run_batched_query, """
+                    UNWIND $batch as game
+                        MATCH (v:Software {uri: game.game_uri})
+                        MERGE (g:Genre {uri: game.genre_uri})
+                            ON CREATE SET g.label = game.genre_label, g.created = $created
+                        MERGE (v)-[m:MEMBER]->(g)
+                            ON CREATE SET m.created = $created
+                """, batches, created=created)
+                nodes_created += sum(summary.counters.nodes_created for summary in summaries)
+                relationships_created += sum(summary.counters.relationships_created for summary in summaries)
+        logger.info(f"Complete. Created {nodes_created} nodes, {relationships_created} relationships")
+
+    def add_date_of_release(self, batch_size: int = 500, batches_per_transaction: int = 4):
         """
         Add release date property to nodes that currently lack it
+        :param batch_size: Number of software entries per statement
+        :param batches_per_transaction: Number of statements committed together in one transaction
         """
-        logger.info("Fetching current instances of all software with release date . . .")
+        logger.info("Adding release dates of all software with release date to existing software . . .")
         wikidata_query = _sparql_results("""
             SELECT DISTINCT ?item ?published ?inception WHERE {
                 ?item wdt:P31/wdt:P279* wd:Q7397.
                 OPTIONAL{?item wdt:P571 ?inception}.
                 OPTIONAL{?item wdt:P577 ?published}.
-                SERVICE wikibase:label { bd:serviceParam wikibase:language "en". }
             }
         """)
-        # NOTE: String ISO time format from WikiData not fully parsed here, Zulu time zone information lost
-        # datetime.fromisoformat(str) function from Python 3.7 can likely do it, but I'm on 3.6
-        wikidata_results = [{
-            "software_uri": software["item"]["value"],
-            "release_date": _strip_timestamp(_get_best_date(software))
-        } for software in wikidata_query["results"]["bindings"] if _get_best_date(software) is not None]
-        logger.info("Complete")
+        # Dates are parsed and written batch by batch while the SPARQL response streams in
+        wikidata_results = _release_dates(wikidata_query)
 
-        logger.info(f"Adding {len(wikidata_results)} release dates to existing software . . .")
+        entries = 0
+        properties_set = 0
         with self.driver.session() as session:
-            query = session.run("""
-                UNWIND $software as software
-                    MATCH (s:Software {uri: software.software_uri}) WHERE NOT EXISTS(s.release)
-                    SET s.release = software.release_date
-            """, software=wikidata_results)
-            result = query.consume()
-            properties_set = result.counters.properties_set
-            logger.info(f"Complete. Set {properties_set} properties")
-
-    def update_software_and_classes(self):
+            for batches in _generate_batches(_generate_batches(wikidata_results, batch_size), batches_per_transaction):
+                entries += sum(len(batch) for batch in batches)
+                summaries = session.write_transaction(_run_batched_query, """
+                    UNWIND $batch as software
+                        MATCH (s:Software {uri: software.software_uri}) WHERE NOT EXISTS(s.release)
+                        SET s.release = software.release_date
+                """, batches)
+                properties_set += sum(summary.counters.properties_set for summary in summaries)
+        logger.info(f"Complete. Read {entries} release dates, set {properties_set} properties")
+
+    def update_software_and_classes(self, dump_path: Optional[str] = None, force_refresh: bool = False,
+                                    max_workers: int = 8):
         """
         Add software which does not currently exist in the database. Create necessary superclass relations to support
         new software nodes. Do not update existing nodes or relationships
+        :param dump_path: Path of a local WikiData truthy N-Triples dump to read the software from. The SPARQL endpoint
+        is queried when omitted
+        :param force_refresh: Query WikiData even if the results are cached on disk
+        :param max_workers: Number of merge transactions run concurrently across both pipelines, should not exceed the
+        connection pool size
         """
-        with self.driver.session() as session:
-            logger.info("Fetching current software instance URIs . . .")
-            current_software = session.run("MATCH (n:Software) RETURN n.uri AS uri, ID(n)").records()
-            current_software = set(software["uri"] for software in current_software)
-            logger.info("Complete")
-
-            logger.info("Fetching current software class URIs . . .")
-            current_classes = session.run("MATCH (n:Class) RETURN n.uri AS uri, ID(n)").records()
-            current_classes = set(subclass["uri"] for subclass in current_classes)
-            logger.info("Complete")
-
-        logger.info("Fetching current list of WikiData software classes . . .")
-        class_nodes = self._get_software_classes()
-        class_nodes = [node for node in class_nodes if node["child_uri"] not in current_classes]
-        logger.info("Complete")
+        # Every node created by this run is stamped with the same timestamp. The merge query uses it to tell nodes
+        # which existed before the run (skipped) from nodes created by an earlier batch of this run (still merged)
+        created = datetime.now(timezone.utc)
 
-        logger.info("Fetching current list of WikiData software instances . . .")
-        software_nodes = self._get_software_instances()
-        software_nodes = [node for node in software_nodes if node["child_uri"] not in current_software]
+        if dump_path is None:
+            class_nodes = self._get_software_classes(force_refresh=force_refresh)
+            software_nodes = self._get_software_instances(
+                force_refresh=force_refresh, new_uris=partial(self._new_uris, "Software", created=created))
+        else:
+            dump = WikidataDump(dump_path)
+            class_nodes = dump.software_classes()
+            software_nodes = dump.software_instances()
 
-        self._merge_data(class_nodes, "Class", "SUBCLASS")
-        self._merge_data(software_nodes, "Software", "INSTANCE")
+        # Both fetches are generators, batches are merged as soon as their rows arrive from WikiData. The class and
+        # instance pipelines run side by side so their SPARQL and database round trips overlap. This is safe in any
+        # order: a class created as the parent of a new instance carries this run's timestamp and is still completed.
+        # Both pipelines submit their transactions to one shared pool, which bounds the total number of concurrent
+        # writers and so the deadlock retries on the Class parents both of them merge
+        logger.info("Merging current list of WikiData software classes and instances . . .")
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=max_workers) as merge_pool, ThreadPoolExecutor(max_workers=2) as pool:
+            merges = [pool.submit(self._merge_data, class_nodes, "Class", "SUBCLASS", created, merge_pool,
+                                  max_pending=2 * max_workers, stop=stop),
+                      pool.submit(self._merge_data, software_nodes, "Software", "INSTANCE", created, merge_pool,
+                                  max_pending=2 * max_workers, stop=stop)]
+            done, _ = wait(merges, return_when=FIRST_EXCEPTION)
+            failed = next((merge for merge in done if merge.exception() is not None), None)
+            if failed is not None:
+                # Stop the other pipeline instead of fetching and merging all of its data before reporting the error
+                stop.set()
+                wait(merges)
+                for merge in merges:
+                    if merge is not failed and merge.exception() is not None:
+                        logger.error("Merge failed as well", exc_info=merge.exception())
+                raise failed.exception()
 
-    def _merge_data(self, data: List[Dict[str, str]], db_label: str, relationship: str, batch_size: int = 500):
+    def _merge_data(self, data: Iterable[Dict[str, str]], db_label: str, relationship: str, created: datetime,
+                    pool: ThreadPoolExecutor, batch_size: int = 500, batches_per_transaction: int = 4,
+                    max_pending: int = 16, stop: Optional[threading.Event] = None):
         """
-        Merge all data passed in the data argument into the neo4j database.
-        :param data: List of dictionaries of all data to be merged
+        Merge all data passed in the data argument into the neo4j database. Rows whose child node already existed
+        before this run are skipped on the server.
+        :param data: Iterable of dictionaries of all data to be merged, consumed one batch at a time
         :param db_label: Label of data (Software, Class, etc.)
-        :param relationship: Type of relationship being added (INSTANCE, SUBCLASS, etc.)
+        :param relationship: Type of relationship being added (INSTANCE, SUBCLASS, etc.), must have an entry in
+        MERGE_QUERIES together with db_label
+        :param created: Timestamp of the current run, set on every node and relationship it creates
+        :param pool: Executor the merge transactions are run on, may be shared with other merges
         :param batch_size: Size of batches to send data to neo4j, default 500
+        :param batches_per_transaction: Number of batches committed together in one transaction, default 4
+        :param max_pending: Number of submitted transactions after which reading data waits for one to finish. This
+        bounds the rows held in memory when data arrives faster than the database commits, and stops reading at the
+        first failed transaction
+        :param stop: Event which ends the merge early when set, used to stop it when another merge of the run fails
+        """
+        logger.info(f"Merging {relationship} relationship for {db_label} entries")
+        query = MERGE_QUERIES[db_label, relationship]
+        entries = 0
+        nodes_created = 0
+        submitted = 0
+        merged = 0
+        pending = set()
+        try:
+            for batches in _generate_batches(_generate_batches(data, batch_size), batches_per_transaction):
+                if stop is not None and stop.is_set():
+                    logger.warning(f"Stopping merge of {db_label} entries after {entries} entries")
+                    for future in pending:
+                        future.cancel()
+                    # Closing a generator source cancels its outstanding WikiData queries
+                    if hasattr(data, "close"):
+                        data.close()
+                    return
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        nodes_created += future.result()
+                        merged += 1
+                        logger.debug(f"Merged {db_label} transaction: [{merged}/{submitted}]")
+                entries += sum(len(batch) for batch in batches)
+                pending.add(pool.submit(self._merge_batches, query, batches, created))
+                submitted += 1
+            for future in as_completed(pending):
+                nodes_created += future.result()
+                merged += 1
+                logger.debug(f"Merged {db_label} transaction: [{merged}/{submitted}]")
+        except BaseException:
+            # Do not leave queued transactions of a failed merge to run in the shared pool
+            for future in pending:
+                future.cancel()
+            raise
+        logger.info(f"Completed merge of {entries} {db_label} entries. Created {nodes_created} nodes")
+
+    def _merge_batches(self, query: str, batches: List[List[Dict[str, str]]], created: datetime) -> int:
+        """
+        Merge a group of batches in its own session and a single transaction, one statement per batch. Concurrent
+        transactions may contend for the same parent nodes, the resulting deadlocks are transient errors and are
+        retried by write_transaction.
+        :param query: The merge query, receiving each batch as $batch
+        :param batches: List of batches of dictionaries to be merged
+        :param created: Timestamp of the current run
+        :return: The number of nodes created
         """
         with self.driver.session() as session:
-            logger.info(f"Merging {relationship} relationship for {len(data)} new {db_label} entries")
-            session.run(
-                f"""UNWIND $batch AS data
-                    MERGE(child: {db_label} {{uri: data.child_uri}})
-                        ON CREATE SET child.label = data.child_label, child.created = datetime()
-                    MERGE(parent: Class {{uri: data.parent_uri}})
-                        ON CREATE SET parent.label = data.parent_label, parent.created = datetime()
-                    MERGE(child)-[relation: {relationship}] -> (parent)
-                        ON CREATE SET relation.created = datetime()
-                """,
-                batch=data,
-            )
-            # Sync statement prevents lazy return of query response, blocks until completion
-            session.sync()
-            logger.info(f"Completed merge of {len(data)} new {db_label} entries")
+            summaries = session.write_transaction(_run_batched_query, query, batches, created=created)
+        return sum(summary.counters.nodes_created for summary in summaries)
+
+    def _new_uris(self, db_label: str, uris: List[str], created: datetime) -> Set[str]:
+        """
+        Return the URIs which _merge_data will not skip: those without a node of db_label, or whose node was created
+        by the current run
+        :param db_label: Label of the nodes (Software, Class, etc.)
+        :param uris: The URIs to check
+        :param created: Timestamp of the current run
+        """
+        with self.driver.session() as session:
+            return set(session.read_transaction(_run_values_query, NEW_URIS_QUERY.format(db_label=db_label),
+                                                uris=uris, created=created))
 
     @staticmethod
-    def _get_software_instances(batch_size: int = 30) -> List[Dict[str, str]]:
+    def _get_software_instances(batch_size: int = 30, max_workers: int = 4, force_refresh: bool = False,
+                                new_uris: Optional[Callable[[List[str]], Set[str]]] = None
+                                ) -> Iterator[Dict[str, str]]:
         """
-        Query wikidata for all instances of the software class at any depth.
-        :return: A list of dictionaries [{"software_uri": <software_uri>, ... }, ... ]
+        Query wikidata for all instances of the software class at any depth. The instances are fetched in batches
+        of base classes, several batches at a time. A batch which runs into the WikiData query time limit is split in
+        half and retried until it is down to a single class. Any other failure stops the fetch.
+        :param batch_size: Number of base classes per query
+        :param max_workers: Number of concurrent queries, keep this low to respect the WikiData rate limits
+        :param force_refresh: Query WikiData even if the results are cached on disk
+        :param new_uris: Function returning which of the given instance URIs are to be merged. Only those are labelled
+        and yielded, all instances are when omitted
+        :return: A generator of dictionaries {"child_uri": <child_uri>, ... }, yielded one query batch at a time
         """
         wikidata_base_classes = _sparql_results(
             """SELECT DISTINCT ?type WHERE {
                  ?item wdt:P31 ?type.
                  ?type (wdt:P279*) wd:Q7397.
-               } ORDER BY (?type)"""
+               } ORDER BY (?type)""",
+            force_refresh=force_refresh,
         )
-        # Shuffle query batch items to prevent WikiData caching of failed queries
-        shuffle(wikidata_base_classes["results"]["bindings"])
-        wikidata_software = []
-        for i, class_batch in enumerate(_generate_batches(wikidata_base_classes["results"]["bindings"], batch_size)):
-            logger.info(f"Fetching software batch: [{i+1}/"
-                        f"{math.ceil(len(wikidata_base_classes['results']['bindings'])/batch_size)}]")
-            # Get base class qids as a list of format ["(wd:{qid})", ...] for batch queries
-            base_class_qids = ' '.join(["(wd:%s)" % base_class['type']['value'].split('/')[-1]
-                                        for base_class in class_batch])
-            software_batch = _sparql_results("""
-                     SELECT DISTINCT ?item ?itemLabel ?type ?typeLabel WHERE {{
-                     VALUES (?type) {{ {base_class_qids} }}.
-                     ?item wdt:P31 ?type.
-                     SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-                }}""".format(base_class_qids=base_class_qids)
-            )
-            logger.debug(f"Fetched {len(software_batch['results']['bindings'])} software labels "
-                         f"from {len(class_batch)} base classes "
-                         f"({len(wikidata_base_classes['results']['bindings']) - (i * batch_size)} "
-                         f"classes remaining)")
-            wikidata_software.extend(software_batch["results"]["bindings"])
-        return [
-            {
-                "child_uri": software["item"]["value"],
-                "child_label": software["itemLabel"]["value"],
-                "parent_uri": software["type"]["value"],
-                "parent_label": software["typeLabel"]["value"],
-            }
-            for software in wikidata_software
-        ]
+        # Kept in query order so the batch queries, and so their cache keys, are the same from run to run
+        base_class_uris = [base_class["type"]["value"] for base_class in wikidata_base_classes]
+        # Parent URIs and labels come from the small set of base classes. Label them once up front and share one pair
+        # of string objects per distinct parent instead of keeping a fresh copy for every instance
+        base_class_labels = _get_labels(base_class_uris, force_refresh=force_refresh)
+        parents = {uri: (uri, label) for uri, label in base_class_labels.items()}
+        fetched = 0
+        # Only max_workers batches are in flight at a time, the next one is submitted once the consumer has taken the
+        # rows of a finished one. Fetched batches never pile up while the database is slower than WikiData
+        queued = deque(_generate_batches(base_class_uris, batch_size))
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            try:
+                while queued or pending:
+                    while queued and len(pending) < max_workers:
+                        class_batch = queued.popleft()
+                        pending[pool.submit(_get_software_batch, class_batch, force_refresh, new_uris)] = class_batch
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        class_batch = pending.pop(future)
+                        try:
+                            software_batch = future.result()
+                        except (requests.RequestException, ijson.JSONError) as e:
+                            if len(class_batch) == 1 or not _is_query_timeout(e):
+                                raise
+                            logger.warning(f"Software batch of {len(class_batch)} base classes timed out, "
+                                           f"retrying in halves: {e}")
+                            half = math.ceil(len(class_batch) / 2)
+                            queued.extendleft((class_batch[half:], class_batch[:half]))
+                            continue
+                        fetched += len(class_batch)
+                        logger.info(f"Fetched {len(software_batch)} software labels from {len(class_batch)} base "
+                                    f"classes [{fetched}/{len(base_class_uris)}]")
+                        for software_uri, software_label, class_uri in software_batch:
+                            parent_uri, parent_label = parents[class_uri]
+                            yield {
+                                "child_uri": software_uri,
+                                "child_label": software_label,
+                                "parent_uri": parent_uri,
+                                "parent_label": parent_label,
+                            }
+            except BaseException:
+                # Cancel the queued queries, or leaving the pool would wait for all of them before the error propagates
+                for future in pending:
+                    future.cancel()
+                raise
 
     @staticmethod
-    def _get_software_classes() -> List[Dict[str, str]]:
+    def _get_software_classes(force_refresh: bool = False) -> Iterator[Dict[str, str]]:
         """
         Query wikidata for all subclasses of the software class at any depth.
-        :return: A list of dictionaries [{"sub_uri": <sub_uri>, "sub_label": <sub_label>, ... }, ... ]
+        :param force_refresh: Query WikiData even if the results are cached on disk
+        :return: A generator of dictionaries {"child_uri": <child_uri>, "child_label": <child_label>, ... }
         """
-        wikidata_subclasses = _sparql_results(
-            """SELECT DISTINCT ?class ?classLabel ?classParent ?classParentLabel WHERE {
+        subclass_bindings = _sparql_results(
+            """SELECT DISTINCT ?class ?classParent WHERE {
                  ?class wdt:P279* wd:Q7397.
                  ?class wdt:P279 ?classParent .
                  ?classParent wdt:P279* wd:Q7397.
-                 SERVICE wikibase:label { bd:serviceParam wikibase:language "en". }
-               }"""
+               }""",
+            force_refresh=force_refresh,
         )
-        return [
-            {
-                "child_uri": subclass["class"]["value"],
-                "child_label": subclass["classLabel"]["value"],
-                "parent_uri": subclass["classParent"]["value"],
-                "parent_label": subclass["classParentLabel"]["value"],
+        wikidata_subclasses = [(subclass["class"]["value"], subclass["classParent"]["value"])
+                               for subclass in subclass_bindings]
+        labels = _get_labels((uri for subclass in wikidata_subclasses for uri in subclass), force_refresh=force_refresh)
+        for class_uri, parent_uri in wikidata_subclasses:
+            yield {
+                "child_uri": class_uri,
+                "child_label": labels[class_uri],
+                "parent_uri": parent_uri,
+                "parent_label": labels[parent_uri],
             }
-            for subclass in wikidata_subclasses["results"]["bindings"]
-        ]
 
 
-def _sparql_results(query: str) -> Dict:
+def _sparql_results(query: str, force_refresh: bool = False) -> Iterator[Dict]:
     """
-    Return the results of a SPARQL query against WikiData
+    Yield the result bindings of a SPARQL query against WikiData, parsed incrementally while the response streams in.
+    Responses are cached on disk for SPARQL_CACHE_TTL seconds, keyed by the query text. A response is only added to the
+    cache once it has been parsed completely, so truncated responses (WikiData timeouts) are never cached
     : param query: The query to run
-    : return: The SPARQL query result, as a dict
+    : param force_refresh: Query WikiData even if the results are cached, the cache entry is replaced
+    : return: A generator of the result bindings of the SPARQL query, as dicts
     """
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql",
-                           agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) "
-                                 "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36")
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    response = sparql.query()
+    cache_path = SPARQL_CACHE_DIR / f"{hashlib.sha1(query.encode()).hexdigest()}.json.gz"
     try:
-        return response.convert()
-    except json.decoder.JSONDecodeError as e:
-        logger.debug(response)
-        raise e
+        cached = not force_refresh and time.time() - cache_path.stat().st_mtime < SPARQL_CACHE_TTL
+    except FileNotFoundError:
+        cached = False
+    if cached:
+        logger.debug(f"Using cached SPARQL results {cache_path}")
+        with gzip.open(cache_path) as cache:
+            yield from ijson.items(cache, "results.bindings.item")
+        return
+
+    # POST keeps long VALUES lists out of the URL, which WikiData caps in length
+    # The slot is held until the response has been read, since WikiData counts a query as running until then
+    with _wikidata_slots:
+        retries = 0
+        while True:
+            response = _wikidata_session.post(WIKIDATA_SPARQL_URL, data={"query": query, "format": "json"},
+                                              stream=True, timeout=WIKIDATA_TIMEOUT)
+            if response.status_code != 429 or retries == WIKIDATA_RATE_LIMIT_RETRIES:
+                break
+            # The slot is kept while waiting, the other queries should not hit the rate limit in the meantime
+            delay = _retry_after(response)
+            response.close()
+            logger.warning(f"Rate limited by WikiData, retrying in {delay:.0f} seconds")
+            time.sleep(delay)
+            retries += 1
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            SPARQL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with NamedTemporaryFile(dir=SPARQL_CACHE_DIR, suffix=".tmp", delete=False) as cache_file:
+                try:
+                    with gzip.GzipFile(fileobj=cache_file, mode="wb", compresslevel=6) as cache:
+                        yield from ijson.items(_TeeReader(response.raw, cache), "results.bindings.item")
+                except BaseException:
+                    cache_file.close()
+                    os.remove(cache_file.name)
+                    raise
+            os.replace(cache_file.name, cache_path)
+        finally:
+            response.close()
+    if not _sparql_cache_pruned.is_set():
+        _sparql_cache_pruned.set()
+        _prune_sparql_cache()
+
+
+def _prune_sparql_cache():
+    """
+    Delete cache entries, and temporary files left by interrupted queries, older than SPARQL_CACHE_TTL. Label queries
+    are keyed by slices of the current URI set, so their keys change as entities are added and old entries would never
+    be replaced
+    """
+    expired = time.time() - SPARQL_CACHE_TTL
+    for path in SPARQL_CACHE_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < expired:
+                path.unlink()
+        except FileNotFoundError:
+            pass
 
 
-def _generate_batches(data: List, batch_size: int) -> List:
+def _retry_after(response: requests.Response, default: float = 60) -> float:
+    """
+    Return the seconds to wait before sending a rate limited query again, from the Retry-After header of the response
+    :param response: The HTTP 429 response
+    :param default: Seconds to wait if the header is missing or invalid
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return default
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+def _is_query_timeout(error: Exception) -> bool:
+    """
+    Return whether a failed WikiData query most likely ran into the query time limit, so that a smaller query may
+    succeed. WikiData either answers a timed out query with an error status, or cuts off a response already streaming
+    :param error: The exception raised by the query
+    """
+    if isinstance(error, (ijson.JSONError, requests.exceptions.ChunkedEncodingError)):
+        return True
+    return (isinstance(error, requests.HTTPError) and error.response is not None
+            and error.response.status_code in (500, 503))
+
+
+class _TeeReader:
+    """
+    File-like wrapper which copies everything read from source into sink
+    """
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        self.sink.write(data)
+        return data
+
+
+def _get_software_batch(class_uris: List[str], force_refresh: bool = False,
+                        new_uris: Optional[Callable[[List[str]], Set[str]]] = None) -> List[Tuple[str, str, str]]:
+    """
+    Query wikidata for the direct instances of a batch of classes
+    :param class_uris: The URIs of the classes
+    :param force_refresh: Query WikiData even if the results are cached on disk
+    :param new_uris: Function returning which of the given instance URIs to keep, all are kept when omitted
+    :return: A list of (instance URI, instance label, class URI) tuples
+    """
+    # Get base class qids as a list of format ["(wd:{qid})", ...] for batch queries
+    base_class_qids = ' '.join(f"(wd:{class_uri.rpartition('/')[2]})" for class_uri in class_uris)
+    software_batch = [(software["item"]["value"], software["type"]["value"]) for software in _sparql_results("""
+             SELECT DISTINCT ?item ?type WHERE {{
+             VALUES (?type) {{ {base_class_qids} }}.
+             ?item wdt:P31 ?type.
+        }}""".format(base_class_qids=base_class_qids),
+        force_refresh=force_refresh,
+    )]
+    if new_uris is not None:
+        # Instances already in the database are skipped by the merge, so they are not labelled or returned at all
+        new = new_uris(list({software_uri for software_uri, _ in software_batch}))
+        software_batch = [(software_uri, class_uri) for software_uri, class_uri in software_batch
+                          if software_uri in new]
+    labels = _get_labels((software_uri for software_uri, _ in software_batch), force_refresh=force_refresh)
+    return [(software_uri, labels[software_uri], class_uri) for software_uri, class_uri in software_batch]
+
+
+def _get_labels(uris: Iterable[str], batch_size: int = 1000, force_refresh: bool = False) -> Dict[str, str]:
+    """
+    Query wikidata for the English labels of entities, falling back to the entity id for entities without one
+    :param uris: The URIs of the entities, may contain duplicates
+    :param batch_size: Number of entities per query
+    :param force_refresh: Query WikiData even if the results are cached on disk
+    :return: Labels keyed by URI
+    """
+    labels = {}
+    # Sorted so the batches, and so the cached queries, are the same from run to run
+    for uri_batch in _generate_batches(sorted(set(uris)), batch_size):
+        qids = ' '.join(f"(wd:{uri.rpartition('/')[2]})" for uri in uri_batch)
+        label_batch = _sparql_results("""
+                 SELECT ?item ?label WHERE {{
+                 VALUES (?item) {{ {qids} }}.
+                 ?item rdfs:label ?label.
+                 FILTER(LANG(?label) = "en")
+            }}""".format(qids=qids),
+            force_refresh=force_refresh,
+        )
+        for label in label_batch:
+            labels[label["item"]["value"]] = label["label"]["value"]
+        for uri in uri_batch:
+            labels.setdefault(uri, uri.rpartition('/')[2])
+    return labels
+
+
+def _run_values_query(tx, query: str, **parameters) -> List:
+    """
+    Run a query inside a managed transaction and return the first value of every record
+    :param tx: The transaction supplied by session.read_transaction
+    :param query: The Cypher query to run
+    :param parameters: Query parameters
+    """
+    return [record[0] for record in tx.run(query, **parameters)]
+
+
+def _run_batched_query(tx, query: str, batches: List[List], **parameters) -> List:
+    """
+    Run a query once per batch inside a single managed transaction. All statements are sent before any result is
+    consumed, so the driver pipelines them and the transaction commits once.
+    :param tx: The transaction supplied by session.write_transaction
+    :param query: The Cypher query to run, receiving each batch as $batch
+    :param batches: List of batches
+    :param parameters: Query parameters shared by every batch
+    :return: The result summaries, in batch order
+    """
+    results = [tx.run(query, batch=batch, **parameters) for batch in batches]
+    return [result.consume() for result in results]
+
+
+def _generate_batches(data: Iterable, batch_size: int) -> Iterator[List]:
     """
     Yield list of items of length batch_size for all items in data.
-    :param data: A list of dicts from SPARQL query return
+    :param data: An iterable of dicts from SPARQL query return, consumed lazily
     :param batch_size: The size of each yielded batch of data elements
     """
-    for i in range(0, len(data), batch_size):
-        yield data[i: i + batch_size]
+    data = iter(data)
+    while True:
+        batch = list(islice(data, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
-def _strip_timestamp(timestamp: str) -> datetime:
+def _release_dates(bindings: Iterable[Dict]) -> Iterator[Dict]:
+    """
+    Yield the URI and release date of every software with a publication (preferred) or inception date
+    :param bindings: SPARQL result bindings with the keys item and optionally published and inception
+    """
+    for software in bindings:
+        timestamp = software.get("published") or software.get("inception")
+        if timestamp is not None:
+            yield {"software_uri": software["item"]["value"], "release_date": _strip_timestamp(timestamp["value"])}
+
+
+def _strip_timestamp(timestamp: str) -> date:
     """
     Return date object stripped from string timestamp
-    :param timestamp: A string timestamp in %Y-%m-%d or Unix time format
+    :param timestamp: A string timestamp in %Y-%m-%dT... or Unix time format
     """
     if not timestamp:
         logger.error(f"Timestamp string is empty")
         return None
-    if timestamp[0] == "t":
-        try:
-            return datetime.utcfromtimestamp(int(timestamp.split("t")[1])).date()
-        except ValueError as e:
-            logger.error(f"UTC Time Parsing Error: {e}")
-            return None
-    else:
-        try:
-            return datetime.strptime(timestamp.split("T")[0], "%Y-%m-%d").date()
-        except ValueError as e:
-            logger.error(f"%Y-%m-%d Time Parsing Error: {e}")
-            return None
+    return _TIMESTAMP_PARSERS.get(timestamp[0], _date_from_iso)(timestamp)
 
-def _get_best_date(software: Dict) -> str:
+
+def _date_from_unix(timestamp: str) -> date:
+    """
+    Return date object from a Unix time string prefixed with t
+    :param timestamp: A string timestamp like t1514357869
     """
-    Return string date for first matched date in software return
+    try:
+        return datetime.utcfromtimestamp(int(timestamp[1:])).date()
+    except ValueError as e:
+        logger.error(f"UTC Time Parsing Error: {e}")
+        return None
+
+
+def _date_from_iso(timestamp: str) -> date:
     """
-    if "published" in software:
-        return software["published"]["value"]
-    if "inception" in software:
-        return software["inception"]["value"]
-    return None
+    Return date object from an ISO timestamp
+    :param timestamp: A string timestamp in %Y-%m-%dT... format
+    """
+    # Slicing the fixed-width fields is several times faster than strptime, which matters over every software
+    # release date. Malformed dates (negative years, zero months) still raise ValueError in int() or date(). Only the
+    # date is kept, the time and Zulu time zone of WikiData timestamps are dropped
+    try:
+        if timestamp[4] != "-" or timestamp[7] != "-":
+            raise ValueError(f"time data {timestamp!r} does not match format '%Y-%m-%d'")
+        return date(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]))
+    except (ValueError, IndexError) as e:
+        logger.error(f"%Y-%m-%d Time Parsing Error: {e}")
+        return None
+
+
+# Timestamp parsers keyed by the first character of the timestamp, anything else is parsed as ISO
+_TIMESTAMP_PARSERS = {"t": _date_from_unix}
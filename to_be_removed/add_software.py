@@ -5,13 +5,18 @@ from neo4j import GraphDatabase
 
 driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "123456"))
 
+# Number of items written per transaction
+BATCH_SIZE = 500
 
-def add_parents(tx, uri, label, parents):
-    for parent in parents:
-        tx.run("MATCH (super:Class {uri: $super_uri})"
-               "MERGE (sw:Software {uri: $sw_uri, label: $sw_label})"
-               "CREATE (sw)-[:INSTANCE]->(super)",
-               sw_uri=uri, sw_label=label, super_uri=parent)
+
+def add_parents(tx, items):
+    tx.run("UNWIND $items AS item "
+           "UNWIND item.parents AS parent "
+           "MATCH (super:Class {uri: parent}) "
+           "MERGE (sw:Software {uri: item.uri}) "
+           "ON CREATE SET sw.label = item.label "
+           "MERGE (sw)-[:INSTANCE]->(super)",
+           items=items)
 
 
 def main():
@@ -20,10 +25,14 @@ def main():
     with open(sparql_root / Path(f"query-{datestamp}.json")) as data_file:
         data = json.load(data_file)
 
+    items = [{"uri": item["item"], "label": item["itemLabel"], "parents": item["types"].split("||")}
+             for item in data]
     with driver.session() as session:
-        for count, item in enumerate(data):
-            print(count, "/", len(data))
-            session.write_transaction(add_parents, item["item"], item["itemLabel"], item["types"].split("||"))
+        session.run("CREATE CONSTRAINT ON (node:Class) ASSERT (node.uri) IS UNIQUE").consume()
+        session.run("CREATE CONSTRAINT ON (node:Software) ASSERT (node.uri) IS UNIQUE").consume()
+        for start in range(0, len(items), BATCH_SIZE):
+            print(start, "/", len(items))
+            session.write_transaction(add_parents, items[start:start + BATCH_SIZE])
 
 
 if __name__ == "__main__":
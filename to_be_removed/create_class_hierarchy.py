@@ -1,72 +1,69 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from datetime import datetime, timezone
 import json
 from pathlib import Path
-import time
-from urllib.error import HTTPError
 
 from neo4j import GraphDatabase
-from SPARQLWrapper import SPARQLWrapper, JSON
+import orjson
+import requests
 
 driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "123456"))
 
 
 def sparql_results(query):
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-    return sparql.query().convert()
-
-
-def get_superclasses(class_uri):
-    query = """SELECT DISTINCT ?class ?classLabel WHERE {
-      wd:%s wdt:P279 ?class.
+    response = requests.post("https://query.wikidata.org/sparql",
+                             data={"query": query, "format": "json"},
+                             headers={"User-Agent": "software-history/create_class_hierarchy",
+                                      "Accept": "application/sparql-results+json"})
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+def get_class_parents():
+    """
+    Fetch every subclass relation below software (Q7397) in one query and group the parents by child URI.
+    Also return the label of every class seen, keyed by URI
+    """
+    query = """SELECT DISTINCT ?class ?classLabel ?classParent ?classParentLabel WHERE {
       ?class wdt:P279* wd:Q7397.
-      SERVICE wikibase:label {
-        bd:serviceParam wikibase:language "en".
-        ?class rdfs:label ?classLabel
-      }
-    }""" % class_uri.split("/")[-1]
-
-    while True:
-        try:
-            time.sleep(1)
-            results = sparql_results(query)
-            break
-        except HTTPError as e:
-            if e.code == 429:
-                print(e.reason)
-                print("Sleeping . . .")
-                time.sleep(6)
-            else:
-                raise e
-
-    return [{"uri": r["class"]["value"], "label": r["classLabel"]["value"]} for r in results["results"]["bindings"]]
-
-
-def add_parents(tx, uri, parents):
-    for parent in parents:
-        tx.run("MERGE (sub:Class {uri: $sub_uri})"
-               "MERGE (super:Class {uri: $super_uri})"
-               "MERGE (sub)-[:SUBCLASS]->(super)"
-               "SET super.label = $super_label",
-               sub_uri=uri, super_uri=parent["uri"], super_label=parent["label"])
-
-
-def create_superclass_tree(class_uri, visited):
-    with driver.session() as session:
-        _create_superclass_tree(class_uri, session, visited)
-
-
-def _create_superclass_tree(class_uri, session, visited):
-    parents = get_superclasses(class_uri)
-    print(parents)
-    session.write_transaction(add_parents, class_uri, parents)
-    for parent in parents:
-        if parent["uri"] not in visited:
-            visited.add(parent["uri"])
-            _create_superclass_tree(parent["uri"], session, visited)
-        else:
-            print("skipping", parent)
+      ?class wdt:P279 ?classParent.
+      ?classParent wdt:P279* wd:Q7397.
+      SERVICE wikibase:label { bd:serviceParam wikibase:language "en". }
+    }"""
+    results = sparql_results(query)
+
+    parents_of = defaultdict(list)
+    labels = {}
+    for r in results["results"]["bindings"]:
+        labels[r["class"]["value"]] = r["classLabel"]["value"]
+        labels[r["classParent"]["value"]] = r["classParentLabel"]["value"]
+        parents_of[r["class"]["value"]].append(r["classParent"]["value"])
+    return parents_of, labels
+
+
+def add_parents(tx, edges, created):
+    tx.run("UNWIND $edges AS edge "
+           "MERGE (sub:Class {uri: edge.sub_uri}) "
+           "ON CREATE SET sub.label = edge.sub_label, sub.created = $created "
+           "MERGE (super:Class {uri: edge.super_uri}) "
+           "ON CREATE SET super.label = edge.super_label, super.created = $created "
+           "MERGE (sub)-[relation:SUBCLASS]->(super) "
+           "ON CREATE SET relation.created = $created",
+           edges=edges, created=created)
+
+
+def superclass_edges(class_uri, parents_of, labels, visited):
+    edges = []
+    queue = deque([class_uri])
+    while queue:
+        child_uri = queue.popleft()
+        for parent_uri in parents_of.get(child_uri, []):
+            edges.append({"sub_uri": child_uri, "sub_label": labels.get(child_uri),
+                          "super_uri": parent_uri, "super_label": labels[parent_uri]})
+            if parent_uri not in visited:
+                visited.add(parent_uri)
+                queue.append(parent_uri)
+    return edges
 
 
 def main():
@@ -80,10 +77,19 @@ def main():
         for type_ in item["types"].split("||"):
             items_by_type[type_].append(item["item"])  # NOTE: Some items have multiple categories
 
+    print("Fetching software class hierarchy . . .")
+    parents_of, labels = get_class_parents()
+
     visited = set()
+    edges = []
     for base_class in items_by_type.keys():
-        print(f"Creating relationships for {base_class}: ", end="")
-        create_superclass_tree(base_class, visited)
+        print(f"Collecting relationships for {base_class}")
+        edges.extend(superclass_edges(base_class, parents_of, labels, visited))
+
+    print(f"Creating {len(edges)} relationships . . .")
+    with driver.session() as session:
+        session.run("CREATE CONSTRAINT ON (node:Class) ASSERT (node.uri) IS UNIQUE").consume()
+        session.write_transaction(add_parents, edges, datetime.now(timezone.utc))
 
 
 if __name__ == "__main__":
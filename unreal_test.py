@@ -1,93 +1,270 @@
-import json
+import atexit
+from collections import namedtuple
+import gzip
+import os
+import sys
+from tempfile import NamedTemporaryFile
+import threading
+
+from flask import Flask, abort, jsonify, request, send_file
+from flask.json.provider import DefaultJSONProvider
+from neo4j import READ_ACCESS, GraphDatabase
+import orjson
+from waitress import serve
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Serialize jsonify responses with orjson, which is much faster than the standard json module and compact by default
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-from flask import Flask, jsonify, request
-from neo4j import GraphDatabase
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "123456"))
+atexit.register(driver.close)
+# Session of each worker thread, reused by every request the thread serves
+_thread_sessions = threading.local()
 
+_graph_file_lock = threading.Lock()
 
-def node_to_dict(node):
-    node_dict = {
-        "Id": str(node.id),
-        "Uri": node["uri"],
-        "Label": node["label"],
-        "Type": next(iter(node.labels))
-    }
-    if node.get("release"):
-        node_dict["ReleaseYear"] = node["release"].year
-        node_dict["ReleaseMonth"] = node["release"].month
-        node_dict["ReleaseDay"] = node["release"].day
 
-    return node_dict
+def _session():
+    """
+    Return the read session of the current thread, opening it on first use. Requests reuse it instead of building a
+    session each, connections still come from the driver's pool. Sessions are closed with the driver on exit
+    """
+    session = getattr(_thread_sessions, "session", None)
+    if session is None or session.closed():
+        session = _thread_sessions.session = driver.session(access_mode=READ_ACCESS)
+    return session
+
+
+# Graph of a query, with nodes as (id, uri, label, type, release) tuples keyed by their numeric id, and relationships
+# as (id, start id, end id, type) tuples. Ids are strings, as they are sent
+Graph = namedtuple("Graph", ["nodes", "relationships"])
+
+# Fields of the start node (s), relationship (r) and end node (e) of every matched relationship. Only what a response
+# contains is returned, the driver does not have to build full node and relationship objects
+_GRAPH_RETURN = """
+    RETURN id(s), s.uri, s.label, labels(s)[0], s.release,
+           id(r), type(r),
+           id(e), e.uri, e.label, labels(e)[0], e.release
+"""
+
+
+def records_to_graph(records):
+    """
+    Collect the records of a query ending in _GRAPH_RETURN into a Graph. Nodes shared by several relationships are
+    only kept once
+    """
+    nodes = {}
+    relationships = []
+    # The driver decodes a new string for every value. Types are interned, so all elements share one string per type
+    intern = sys.intern
+    for s_id, s_uri, s_label, s_type, s_release, r_id, r_type, e_id, e_uri, e_label, e_type, e_release in records:
+        start = nodes.get(s_id)
+        if start is None:
+            start = nodes[s_id] = (str(s_id), s_uri, s_label, intern(s_type), s_release)
+        end = nodes.get(e_id)
+        if end is None:
+            end = nodes[e_id] = (str(e_id), e_uri, e_label, intern(e_type), e_release)
+        relationships.append((str(r_id), start[0], end[0], intern(r_type)))
+
+    return Graph(nodes, relationships)
+
+
+# Graph queries of the routes. The text never changes, so the server plans each one once
+NODE_QUERY = "MATCH (s {uri: $uri})-[r]->(e)" + _GRAPH_RETURN
+CLASS_QUERY = "MATCH (s:Software)-[r:INSTANCE]->(e:Class {uri: $uri})" + _GRAPH_RETURN
+GRAPH_QUERY = "MATCH (s)-[r]->(e:Class)" + _GRAPH_RETURN
+
+
+def query_graph(query, **parameters):
+    """
+    Run a graph query in a read transaction of the current thread's session, which a cluster can route to a reader
+    and which is retried on transient errors
+    :param query: A query ending in _GRAPH_RETURN
+    :param parameters: Query parameters
+    """
+    return _session().read_transaction(_read_graph, query, **parameters)
+
+
+def _read_graph(tx, query, **parameters):
+    return records_to_graph(tx.run(query, **parameters))
+
 
+def nodes_to_dicts(nodes):
+    """
+    Convert node tuples to response dictionaries. The whole loop runs in one frame, without a function call per node
+    """
+    node_dicts = []
+    append = node_dicts.append
+    for node_id, uri, label, type_, release in nodes:
+        node_dict = {
+            "Id": node_id,
+            "Uri": uri,
+            "Label": label,
+            "Type": type_
+        }
+        if release:
+            node_dict["ReleaseYear"] = release.year
+            node_dict["ReleaseMonth"] = release.month
+            node_dict["ReleaseDay"] = release.day
+        append(node_dict)
 
-def relationship_to_dict(relationship):
+    return node_dicts
+
+
+def relationships_to_dicts(relationships):
+    """
+    Convert relationship tuples to response dictionaries
+    """
+    return [{
+        "Id": relationship_id,
+        "StartId": start_id,
+        "EndId": end_id,
+        "Type": type_
+    } for relationship_id, start_id, end_id, type_ in relationships]
+
+
+def graph_to_dict(graph):
     return {
-        "Id": str(relationship.id),
-        "StartId": str(relationship.start_node.id),
-        "EndId": str(relationship.end_node.id),
-        "Type": str(relationship.type)
+        "Nodes": nodes_to_dicts(graph.nodes.values()),
+        "Relationships": relationships_to_dicts(graph.relationships)
     }
 
 
+def graph_to_columns(graph):
+    """
+    Convert a graph to a columnar response: one list per field instead of one dictionary per element, so the keys are
+    sent once. Node and relationship types are sent once in Types, the type columns hold indexes into it. Release
+    fields are null for nodes without a release date
+    """
+    nodes = list(graph.nodes.values())
+    relationships = graph.relationships
+    releases = [node[4] for node in nodes]
+    type_indexes = {}
+    return {
+        "NodeIds": [node[0] for node in nodes],
+        "NodeUris": [node[1] for node in nodes],
+        "NodeLabels": [node[2] for node in nodes],
+        "NodeTypes": [type_indexes.setdefault(node[3], len(type_indexes)) for node in nodes],
+        "NodeReleaseYears": [release.year if release else None for release in releases],
+        "NodeReleaseMonths": [release.month if release else None for release in releases],
+        "NodeReleaseDays": [release.day if release else None for release in releases],
+        "RelationshipIds": [relationship[0] for relationship in relationships],
+        "RelationshipStartIds": [relationship[1] for relationship in relationships],
+        "RelationshipEndIds": [relationship[2] for relationship in relationships],
+        "RelationshipTypes": [type_indexes.setdefault(relationship[3], len(type_indexes))
+                              for relationship in relationships],
+        # Built last, after both type columns have added their types
+        "Types": list(type_indexes)
+    }
+
+
+# Response layouts selectable with the format query parameter
+GRAPH_FORMATS = {
+    "rows": graph_to_dict,
+    "columnar": graph_to_columns
+}
+
+
+# Cached /graph response of each format. Absolute, as send_file resolves relative paths against the app root rather
+# than the working directory
+GRAPH_FILES = {
+    "rows": os.path.abspath("graph.txt"),
+    "columnar": os.path.abspath("graph_columnar.txt")
+}
+
+
+def _graph_format():
+    """
+    Return the name of the format requested in the query string, rows by default
+    """
+    graph_format = request.args.get("format", "rows", type=str)
+    if graph_format not in GRAPH_FORMATS:
+        abort(400, f"Unknown format {graph_format}, expected one of {', '.join(GRAPH_FORMATS)}")
+    return graph_format
+
+
 @app.route("/node", methods=["GET"])
 def get_node():
     uri = request.args.get("uri", type=str)
-    with driver.session() as session:
-        graph = session.run("MATCH (n1 {uri: $uri})-[r]->(n2) RETURN n1, r, n2", uri=uri).graph()
+    graph = query_graph(NODE_QUERY, uri=uri)
 
-    dict_relationships = [relationship_to_dict(r) for r in graph.relationships]
-    dict_nodes = [node_to_dict(n) for n in graph.nodes]
-
-    return jsonify({
-        "Nodes": dict_nodes,
-        "Relationships": dict_relationships
-    })
+    return jsonify(graph_to_dict(graph))
 
 
 @app.route("/class", methods=["GET"])
 def get_class():
     uri = request.args.get("uri", type=str)
+    to_payload = GRAPH_FORMATS[_graph_format()]
 
-    with driver.session() as session:
-        graph = session.run("MATCH (s:Software)-[r:INSTANCE]->(c:Class {uri: $uri}) RETURN s,r,c",
-                            uri=uri).graph()
-
-        dict_relationships = [relationship_to_dict(r) for r in graph.relationships]
-        dict_nodes = [node_to_dict(n) for n in graph.nodes]
+    graph = query_graph(CLASS_QUERY, uri=uri)
 
-    return jsonify({
-        "Nodes": dict_nodes,
-        "Relationships": dict_relationships
-    })
+    return jsonify(to_payload(graph))
 
 
 @app.route("/graph", methods=["GET"])
 def get_graph():
-    try:
-        with open("graph.txt") as graph_file:
-            response_str = graph_file.read()
-    except FileNotFoundError:
-        with driver.session() as session:
-            graph = session.run("MATCH (n)-[r]->(c:Class) RETURN n, r, c").graph()
+    graph_format = _graph_format()
+    graph_path = GRAPH_FILES[graph_format]
+    _write_graph_file(graph_path, GRAPH_FORMATS[graph_format])
+    # Served from disk so the WSGI server can use sendfile. Conditional requests get a 304 while the file is unchanged.
+    # Clients accepting gzip get the copy compressed when the file was written, nothing is compressed per request.
+    # Indexing checks the quality, so gzip;q=0 and *;q=0 are refused, which a containment test would miss
+    if request.accept_encodings["gzip"] > 0:
+        response = send_file(graph_path + ".gz", mimetype="application/json", conditional=True)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = send_file(graph_path, mimetype="application/json", conditional=True)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def _write_graph_file(graph_path, to_payload):
+    """
+    Query the graph and write it to graph_path, along with a gzip compressed copy at graph_path.gz, unless both files
+    already exist
+    :param graph_path: The file to write
+    :param to_payload: The converter of the graph to the response layout
+    """
+    compressed_path = graph_path + ".gz"
+    with _graph_file_lock:
+        if os.path.exists(compressed_path) and os.path.exists(graph_path):
+            return
 
-        dict_relationships = [relationship_to_dict(r) for r in graph.relationships]
-        dict_nodes = [node_to_dict(n) for n in graph.nodes]
+        if os.path.exists(graph_path):
+            with open(graph_path, "rb") as graph_file:
+                graph_bytes = graph_file.read()
+        else:
+            graph = query_graph(GRAPH_QUERY)
+            # Written as bytes, decoding orjson's output to str would cost most of what it saves
+            graph_bytes = orjson.dumps(to_payload(graph))
+            _replace_file(graph_path, graph_bytes)
+        _replace_file(compressed_path, gzip.compress(graph_bytes, compresslevel=9))
 
-        with open("graph.txt", "w") as graph_file:
-            response_str = json.dumps({
-                "Nodes": dict_nodes,
-                "Relationships": dict_relationships
-            }, separators=(",", ":"))
-            print(response_str, file=graph_file)
 
-    return response_str
+def _replace_file(path, contents):
+    """
+    Write a file through a temporary file, so a concurrent reader never sees it partially written
+    """
+    with NamedTemporaryFile(dir=os.path.dirname(path), prefix="graph", delete=False) as temporary_file:
+        temporary_file.write(contents)
+    os.replace(temporary_file.name, path)
 
 
 def main():
-    app.run(port=8080, debug=True)
+    # waitress instead of the single-process Werkzeug development server. Each of its worker threads keeps one session.
+    # Bound to localhost like the development server was, waitress would otherwise listen on every interface
+    serve(app, host="127.0.0.1", port=8080, threads=8)
 
 
 if __name__ == "__main__":